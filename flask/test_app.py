@@ -2,271 +2,376 @@ import unittest
 import urllib.parse
 
 from contextlib import contextmanager
+from functools import lru_cache
+from types import MappingProxyType
 from flask import url_for
 from flask_testing import TestCase
+from sqlalchemy import event
+from sqlalchemy.pool import StaticPool
 from notejam import app, db
 from notejam.config import TestingConfig
 from notejam.models import User, Pad, Note
 
 app.config.from_object(TestingConfig)
+app.config['TESTING'] = True
+app.config['CSRF_ENABLED'] = False
+# a single in-memory database shared by every session/connection;
+# each pytest-xdist worker is its own process and so gets its own database
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'connect_args': {'check_same_thread': False},
+    'poolclass': StaticPool
+}
+# no query logging, query recording or modification tracking in tests
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['SQLALCHEMY_RECORD_QUERIES'] = False
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# pysqlite does not emit BEGIN itself, which breaks SAVEPOINT support.
+# See: https://docs.sqlalchemy.org/en/14/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl
+@event.listens_for(db.engine, 'connect')
+def do_connect(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+@event.listens_for(db.engine, 'begin')
+def do_begin(conn):
+    conn.exec_driver_sql('BEGIN')
+
+@lru_cache(maxsize=32)
+def _hash_password(password):
+    ''' hash each distinct test password only once '''
+    user = User()
+    user.set_password(password)
+    return user.password
+
+_URL_ID_PLACEHOLDER = 987654321
+
+def _url_template(endpoint, param):
+    ''' build a url once and turn the given int param into a `{}` slot '''
+    url = url_for(endpoint, **{param: _URL_ID_PLACEHOLDER})
+    return url.replace(str(_URL_ID_PLACEHOLDER), '{}')
+
+# users shared by all tests, inserted once in setUpModule
+OWNER_ID = 1
+OTHER_ID = 2
+
+def setUpModule():
+    db.create_all()
+    # fire the app's own create_tables hook now, outside of any test
+    # transaction, so it won't try to BEGIN inside a test's transaction
+    app.try_trigger_before_first_request_functions()
+    with db.engine.begin() as conn:
+        conn.execute(User.__table__.insert(), [
+            {'id': OWNER_ID, 'email': 'email@example.com',
+             'password': _hash_password('password')},
+            {'id': OTHER_ID, 'email': 'another@example.com',
+             'password': _hash_password('password')},
+        ])
 
 class NotejamBaseTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with app.test_request_context():
+            cls.URL_SIGNUP = url_for('signup')
+            cls.URL_SIGNIN = url_for('signin')
+            cls.URL_HOME = url_for('home')
+            cls.URL_CREATE_PAD = url_for('create_pad')
+            cls.URL_CREATE_NOTE = url_for('create_note')
+            cls.URL_EDIT_PAD = _url_template('edit_pad', 'pad_id')
+            cls.URL_DELETE_PAD = _url_template('delete_pad', 'pad_id')
+            cls.URL_PAD_NOTES = _url_template('pad_notes', 'pad_id')
+            cls.URL_EDIT_NOTE = _url_template('edit_note', 'note_id')
+            cls.URL_DELETE_NOTE = _url_template('delete_note', 'note_id')
+
     def setUp(self):
-        db.create_all()
+        '''
+        Run every test inside an outer transaction with a SAVEPOINT,
+        so the schema is created once and each test is rolled back.
+        '''
+        self.connection = db.engine.connect()
+        self.trans = self.connection.begin()
+        db.session = db.create_scoped_session(
+            options={'bind': self.connection, 'binds': {}})
+        self.nested = self.connection.begin_nested()
+
+        @event.listens_for(db.session(), 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if not self.nested.is_active:
+                self.nested = self.connection.begin_nested()
 
     def tearDown(self):
         db.session.remove()
-        db.drop_all()
+        self.trans.rollback()
+        self.connection.close()
 
     def create_app(self):
-        test_app = app
-        test_app.config['TESTING'] = True
-        test_app.config['CSRF_ENABLED'] = False
-        return test_app
+        return app
+
+    def assertRedirectsPath(self, response, location):
+        '''
+        Like `assertRedirects`, but compares path and query only, so it
+        works with both relative and absolute Location headers
+        '''
+        self.assertIn(response.status_code, (301, 302, 303, 305, 307))
+        actual = urllib.parse.urlparse(response.location)
+        expected = urllib.parse.urlparse(location)
+        self.assertEqual(expected.path, actual.path)
+        self.assertEqual(urllib.parse.parse_qs(expected.query),
+                         urllib.parse.parse_qs(actual.query))
+
+    def _save(self, *objects):
+        db.session.add_all(objects)
+        db.session.commit()
 
     def create_user(self, **kwargs):
         user = User(email=kwargs['email'])
-        user.set_password(kwargs['password'])
-        db.session.add(user)
-        db.session.commit()
+        user.password = _hash_password(kwargs['password'])
+        self._save(user)
         return user
 
     def create_pad(self, **kwargs):
         pad = Pad(**kwargs)
-        db.session.add(pad)
-        db.session.commit()
+        self._save(pad)
         return pad
 
-    def create_note(self, **kwargs):
-        note = Note(**kwargs)
-        db.session.add(note)
-        db.session.commit()
+    def create_pad_note(self, user, pad_name='pad', **kwargs):
+        ''' create a note in a new pad with a single commit '''
+        pad = Pad(name=pad_name, user=user)
+        note = Note(pad=pad, user=user, **kwargs)
+        self._save(pad, note)
         return note
 
+@lru_cache(maxsize=None)
+def _session_cookie(user_id):
+    ''' signed session cookie value of a signed in user '''
+    serializer = app.session_interface.get_signing_serializer(app)
+    return serializer.dumps({'user_id': user_id, '_fresh': True})
+
 @contextmanager
-def signed_in_user(user):
+def signed_in_user(client, user):
     '''
     Signed in user context
     Usage:
         user = get_user()
-        with signed_in_user(user) as c:
+        with signed_in_user(self.client, user) as c:
             response = c.get(...)
     '''
-    with app.test_client() as c:
-        with c.session_transaction() as sess:
-            sess['user_id'] = user.id
-            sess['_fresh'] = True
-        yield c
+    client.set_cookie('localhost', app.session_cookie_name,
+                      _session_cookie(user.id))
+    try:
+        yield client
+    finally:
+        client.delete_cookie('localhost', app.session_cookie_name)
 
 class SignupTestCase(NotejamBaseTestCase):
+    _USER_DATA = MappingProxyType({
+        'email': 'testt@example.com',
+        'password': 'secure_password',
+        'repeat_password': 'secure_password'
+    })
+    _USER_DATA_KEYS = frozenset(_USER_DATA)
+
     def _get_user_data(self, **kwargs):
-        user_data = {
-            'email': 'testt@example.com',
-            'password': 'secure_password',
-            'repeat_password': 'secure_password'
-        }
-        user_data.update(**kwargs)
-        return user_data
+        return {**self._USER_DATA, **kwargs}
 
     def test_signup_success(self):
-        response = self.client.post(url_for("signup"), data=self._get_user_data())
-        self.assertRedirects(response, url_for('signin'))
-        self.assertEqual(1, User.query.count())
+        response = self.client.post(self.URL_SIGNUP, data=self._get_user_data())
+        self.assertRedirectsPath(response, self.URL_SIGNIN)
+        self.assertEqual(
+            1, User.query.filter_by(email=self._USER_DATA['email']).count())
 
     def test_signup_fail_required_fields(self):
-        response = self.client.post(url_for("signup"), data={})
+        response = self.client.post(self.URL_SIGNUP, data={})
         form_errors = self.get_context_variable('form').errors
-        self.assertEqual(set(self._get_user_data().keys()), set(form_errors.keys()))
+        self.assertEqual(self._USER_DATA_KEYS, set(form_errors.keys()))
 
     def test_signup_fail_email_exists(self):
         data = self._get_user_data()
         self.create_user(**data)
-        response = self.client.post(url_for("signup"), data=self._get_user_data())
+        response = self.client.post(self.URL_SIGNUP, data=self._get_user_data())
         form_errors = self.get_context_variable('form').errors
         self.assertEqual(['email'], list(form_errors.keys()))
 
     def test_signup_fail_invalid_email(self):
         data = self._get_user_data()
         data['email'] = 'invalid email'
-        response = self.client.post(url_for("signup"), data=data)
+        response = self.client.post(self.URL_SIGNUP, data=data)
         form_errors = self.get_context_variable('form').errors
         self.assertEqual(['email'], list(form_errors.keys()))
 
     def test_signup_fail_passwords_dont_match(self):
         invalid_data = self._get_user_data(password='another pass')
-        response = self.client.post(url_for('signup'), data=invalid_data)
+        response = self.client.post(self.URL_SIGNUP, data=invalid_data)
         form_errors = self.get_context_variable('form').errors
         self.assertEqual(['repeat_password'], list(form_errors.keys()))
 
 class SigninTestCase(NotejamBaseTestCase):
+    _USER_DATA = MappingProxyType({
+        'email': 'testt@example.com',
+        'password': 'secure_password'
+    })
+    _USER_DATA_KEYS = frozenset(_USER_DATA)
+
     def _get_user_data(self, **kwargs):
-        user_data = {
-            'email': 'testt@example.com',
-            'password': 'secure_password'
-        }
-        user_data.update(**kwargs)
-        return user_data
+        return {**self._USER_DATA, **kwargs}
 
     def test_signin_success(self):
         data = self._get_user_data()
         self.create_user(**data)
-        response = self.client.post(url_for('signin'), data=data)
-        self.assertRedirects(response, url_for('home'))
+        response = self.client.post(self.URL_SIGNIN, data=data)
+        self.assertRedirectsPath(response, self.URL_HOME)
 
     def test_signin_fail(self):
-        response = self.client.post(url_for('signin'), data=self._get_user_data())
+        response = self.client.post(self.URL_SIGNIN, data=self._get_user_data())
         self.assertIn('Wrong email or password', response.data.decode())
 
     def test_signin_fail_required_fields(self):
-        response = self.client.post(url_for("signin"), data={})
+        response = self.client.post(self.URL_SIGNIN, data={})
         form_errors = self.get_context_variable('form').errors
-        self.assertEqual(set(self._get_user_data().keys()), set(form_errors.keys()))
+        self.assertEqual(self._USER_DATA_KEYS, set(form_errors.keys()))
 
     def test_signin_fail_invalid_email(self):
         data = self._get_user_data()
         data['email'] = 'invalid email'
-        response = self.client.post(url_for("signin"), data=data)
+        response = self.client.post(self.URL_SIGNIN, data=data)
         form_errors = self.get_context_variable('form').errors
         self.assertEqual(['email'], list(form_errors.keys()))
 
 class PadTestCase(NotejamBaseTestCase):
 
     def test_create_success(self):
-        user = self.create_user(email='testt@example.com', password='password')
-        with signed_in_user(user) as c:
-            response = c.post(url_for('create_pad'), data={'name': 'pad'})
-            self.assertRedirects(response, url_for('home'))
+        user = User.query.get(OWNER_ID)
+        with signed_in_user(self.client, user) as c:
+            response = c.post(self.URL_CREATE_PAD, data={'name': 'pad'})
+            self.assertRedirectsPath(response, self.URL_HOME)
             self.assertEqual(1, Pad.query.count())
 
     def test_create_fail_required_name(self):
-        user = self.create_user(email='testt@example.com', password='password')
-        with signed_in_user(user) as c:
-            response = c.post(url_for('create_pad'), data={})
+        user = User.query.get(OWNER_ID)
+        with signed_in_user(self.client, user) as c:
+            response = c.post(self.URL_CREATE_PAD, data={})
             form_errors = self.get_context_variable('form').errors
             self.assertEqual(['name'], list(form_errors.keys()))
 
     def test_create_fail_anonymous_user(self):
-        response = self.client.post(url_for('create_pad'), data={'name': 'pad'})
-        expected_redirect = url_for('signin') + f"?next={urllib.parse.quote(url_for('create_pad'))}"
-        self.assertRedirects(response, expected_redirect)
+        response = self.client.post(self.URL_CREATE_PAD, data={'name': 'pad'})
+        expected_redirect = self.URL_SIGNIN + f"?next={urllib.parse.quote(self.URL_CREATE_PAD)}"
+        self.assertRedirectsPath(response, expected_redirect)
 
     def test_edit_success(self):
-        user = self.create_user(email='testt@example.com', password='password')
+        user = User.query.get(OWNER_ID)
         pad = self.create_pad(name='pad', user=user)
-        with signed_in_user(user) as c:
+        with signed_in_user(self.client, user) as c:
             new_name = 'new pad name'
-            response = c.post(url_for('edit_pad', pad_id=pad.id), data={'name': new_name})
-            self.assertRedirects(response, url_for('pad_notes', pad_id=pad.id))
-            self.assertEqual(new_name, Pad.query.get(pad.id).name)
+            response = c.post(self.URL_EDIT_PAD.format(pad.id), data={'name': new_name})
+            self.assertRedirectsPath(response, self.URL_PAD_NOTES.format(pad.id))
+            self.assertEqual(new_name, db.session.get(Pad, pad.id).name)
 
     def test_edit_fail_required_name(self):
-        user = self.create_user(email='testt@example.com', password='password')
+        user = User.query.get(OWNER_ID)
         pad = self.create_pad(name='pad', user=user)
-        with signed_in_user(user) as c:
-            response = c.post(url_for('edit_pad', pad_id=pad.id), data={'name': ''})
+        with signed_in_user(self.client, user) as c:
+            response = c.post(self.URL_EDIT_PAD.format(pad.id), data={'name': ''})
             form_errors = self.get_context_variable('form').errors
             self.assertEqual(['name'], list(form_errors.keys()))
 
     def test_edit_fail_anothers_user(self):
-        user = self.create_user(email='email@example.com', password='password')
+        user = User.query.get(OWNER_ID)
         pad = self.create_pad(name='pad', user=user)
-        another_user = self.create_user(email='another@example.com', password='password')
-        with signed_in_user(another_user) as c:
-            response = c.post(url_for('edit_pad', pad_id=pad.id), data={})
+        another_user = User.query.get(OTHER_ID)
+        with signed_in_user(self.client, another_user) as c:
+            response = c.post(self.URL_EDIT_PAD.format(pad.id), data={})
             self.assertEqual(404, response.status_code)
 
     def test_delete_success(self):
-        user = self.create_user(email='email@example.com', password='password')
+        user = User.query.get(OWNER_ID)
         pad = self.create_pad(name='pad', user=user)
-        with signed_in_user(user) as c:
-            response = c.post(url_for('delete_pad', pad_id=pad.id))
-            self.assertRedirects(response, url_for('home'))
+        with signed_in_user(self.client, user) as c:
+            response = c.post(self.URL_DELETE_PAD.format(pad.id))
+            self.assertRedirectsPath(response, self.URL_HOME)
             self.assertEqual(0, Pad.query.count())
 
     def test_delete_fail_anothers_user(self):
-        user = self.create_user(email='email@example.com', password='password')
+        user = User.query.get(OWNER_ID)
         pad = self.create_pad(name='pad', user=user)
-        another_user = self.create_user(email='another@example.com', password='password')
-        with signed_in_user(another_user) as c:
-            response = c.post(url_for('delete_pad', pad_id=pad.id))
+        another_user = User.query.get(OTHER_ID)
+        with signed_in_user(self.client, another_user) as c:
+            response = c.post(self.URL_DELETE_PAD.format(pad.id))
             self.assertEqual(404, response.status_code)
 
 class NoteTestCase(NotejamBaseTestCase):
+    _NOTE_DATA = MappingProxyType({
+        'name': 'note', 'pad': 0, 'text': 'text'
+    })
+    _NOTE_DATA_KEYS = frozenset(_NOTE_DATA)
+
     def _get_note_data(self, **kwargs):
-        note_data = {
-            'name': 'note', 'pad': 0, 'text': 'text'
-        }
-        note_data.update(**kwargs)
-        return note_data
+        return {**self._NOTE_DATA, **kwargs}
 
     def test_create_success(self):
-        user = self.create_user(email='email@example.com', password='password')
+        user = User.query.get(OWNER_ID)
         pad = self.create_pad(name='pad', user=user)
-        with signed_in_user(user) as c:
-            response = c.post(url_for('create_note'), data=self._get_note_data(pad=pad.id))
-            self.assertRedirects(response, url_for('home'))
+        with signed_in_user(self.client, user) as c:
+            response = c.post(self.URL_CREATE_NOTE, data=self._get_note_data(pad=pad.id))
+            self.assertRedirectsPath(response, self.URL_HOME)
             self.assertEqual(1, Note.query.count())
 
     def test_create_fail_required_fields(self):
-        user = self.create_user(email='email@example.com', password='password')
+        user = User.query.get(OWNER_ID)
         pad = self.create_pad(name='pad', user=user)
-        with signed_in_user(user) as c:
-            response = c.post(url_for('create_note'), data={})
+        with signed_in_user(self.client, user) as c:
+            response = c.post(self.URL_CREATE_NOTE, data={})
             form_errors = self.get_context_variable('form').errors
-            self.assertEqual(set(self._get_note_data().keys()), set(form_errors.keys()))
+            self.assertEqual(self._NOTE_DATA_KEYS, set(form_errors.keys()))
 
     def test_create_fail_anothers_pad(self):
-        user = self.create_user(email='email@example.com', password='password')
-        another_user = self.create_user(email='another@example.com', password='password')
+        user = User.query.get(OWNER_ID)
+        another_user = User.query.get(OTHER_ID)
         pad = self.create_pad(name='pad', user=another_user)
-        with signed_in_user(user) as c:
-            response = c.post(url_for('create_note'), data=self._get_note_data(pad=pad.id))
+        with signed_in_user(self.client, user) as c:
+            response = c.post(self.URL_CREATE_NOTE, data=self._get_note_data(pad=pad.id))
             self.assertEqual(404, response.status_code)
 
     def test_edit_success(self):
-        user = self.create_user(email='email@example.com', password='password')
-        pad = self.create_pad(name='pad', user=user)
-        note = self.create_note(name='note', text='text', pad=pad.id, user=user)
-        with signed_in_user(user) as c:
+        user = User.query.get(OWNER_ID)
+        note = self.create_pad_note(user, name='note', text='text')
+        with signed_in_user(self.client, user) as c:
             new_name = 'new note name'
-            response = c.post(url_for('edit_note', note_id=note.id), data=self._get_note_data(name=new_name))
-            self.assertRedirects(response, url_for('home'))
-            self.assertEqual(new_name, Note.query.get(note.id).name)
+            response = c.post(self.URL_EDIT_NOTE.format(note.id), data=self._get_note_data(name=new_name))
+            self.assertRedirectsPath(response, self.URL_HOME)
+            self.assertEqual(new_name, db.session.get(Note, note.id).name)
 
     def test_edit_fail_required_fields(self):
-        user = self.create_user(email='email@example.com', password='password')
-        pad = self.create_pad(name='pad', user=user)
-        note = self.create_note(name='note', text='text', pad=pad.id, user=user)
-        with signed_in_user(user) as c:
-            response = c.post(url_for('edit_note', note_id=note.id), data={})
+        user = User.query.get(OWNER_ID)
+        note = self.create_pad_note(user, name='note', text='text')
+        with signed_in_user(self.client, user) as c:
+            response = c.post(self.URL_EDIT_NOTE.format(note.id), data={})
             form_errors = self.get_context_variable('form').errors
-            self.assertEqual(set(self._get_note_data().keys()), set(form_errors.keys()))
+            self.assertEqual(self._NOTE_DATA_KEYS, set(form_errors.keys()))
 
     def test_edit_fail_anothers_user(self):
-        user = self.create_user(email='email@example.com', password='password')
-        pad = self.create_pad(name='pad', user=user)
-        note = self.create_note(name='note', text='text', pad=pad.id, user=user)
-        another_user = self.create_user(email='another@example.com', password='password')
-        with signed_in_user(another_user) as c:
-            response = c.post(url_for('edit_note', note_id=note.id), data={})
+        user = User.query.get(OWNER_ID)
+        note = self.create_pad_note(user, name='note', text='text')
+        another_user = User.query.get(OTHER_ID)
+        with signed_in_user(self.client, another_user) as c:
+            response = c.post(self.URL_EDIT_NOTE.format(note.id), data={})
             self.assertEqual(404, response.status_code)
 
     def test_delete_success(self):
-        user = self.create_user(email='email@example.com', password='password')
-        pad = self.create_pad(name='pad', user=user)
-        note = self.create_note(name='note', text='text', pad=pad.id, user=user)
-        with signed_in_user(user) as c:
-            response = c.post(url_for('delete_note', note_id=note.id))
-            self.assertRedirects(response, url_for('home'))
+        user = User.query.get(OWNER_ID)
+        note = self.create_pad_note(user, name='note', text='text')
+        with signed_in_user(self.client, user) as c:
+            response = c.post(self.URL_DELETE_NOTE.format(note.id))
+            self.assertRedirectsPath(response, self.URL_HOME)
             self.assertEqual(0, Note.query.count())
 
     def test_delete_fail_anothers_user(self):
-        user = self.create_user(email='email@example.com', password='password')
-        pad = self.create_pad(name='pad', user=user)
-        note = self.create_note(name='note', text='text', pad=pad.id, user=user)
-        another_user = self.create_user(email='another@example.com', password='password')
-        with signed_in_user(another_user) as c:
-            response = c.post(url_for('delete_note', note_id=note.id))
+        user = User.query.get(OWNER_ID)
+        note = self.create_pad_note(user, name='note', text='text')
+        another_user = User.query.get(OTHER_ID)
+        with signed_in_user(self.client, another_user) as c:
+            response = c.post(self.URL_DELETE_NOTE.format(note.id))
             self.assertEqual(404, response.status_code)
 
 if __name__ == '__main__':